@@ -2,23 +2,27 @@
 Agentic sampling loop that calls the Anthropic API and local implementation of anthropic-defined computer use tools.
 """
 
+import copy
+import functools
+import hashlib
 import platform
-from collections.abc import Callable
+from collections.abc import Callable, Iterable
+from dataclasses import dataclass, field
 from datetime import datetime
 from enum import StrEnum
+from operator import attrgetter
 from typing import Any, cast
 
 import httpx
 import json
 from anthropic import (
-    Anthropic,
-    AnthropicBedrock,
-    AnthropicVertex,
     APIError,
     APIResponseValidationError,
     APIStatusError,
+    AsyncAnthropic,
+    AsyncAnthropicBedrock,
+    AsyncAnthropicVertex,
 )
-from openai import OpenAI
 from anthropic.types.beta import (
     BetaCacheControlEphemeralParam,
     BetaContentBlockParam,
@@ -38,226 +42,354 @@ from .tools import (
     ToolVersion,
 )
 
+try:
+    import orjson
+
+    def _json_dumps(obj: Any) -> str:
+        return orjson.dumps(obj).decode()
+
+    _json_loads = orjson.loads
+except ImportError:
+
+    def _json_dumps(obj: Any) -> str:
+        return json.dumps(obj, ensure_ascii=False, separators=(",", ":"))
+
+    _json_loads = json.loads
+
 PROMPT_CACHING_BETA_FLAG = "prompt-caching-2024-07-31"
 
 
+# Only short argument strings are cached: models repeat a small set of them
+# ({"action":"screenshot"}, ...), while long str_replace_editor payloads never repeat
+CACHED_TOOL_ARGUMENTS_MAX_LENGTH = 256
+
+
+@functools.lru_cache(maxsize=512)
+def _parse_short_tool_arguments(arguments: str) -> dict[str, Any]:
+    # the cached dict is shared, it must be copied before it is handed out
+    return _json_loads(arguments)
+
+
+def _parse_tool_arguments(arguments: str) -> dict[str, Any]:
+    """Parse the JSON arguments of a tool call into a dict owned by the caller."""
+    if len(arguments) > CACHED_TOOL_ARGUMENTS_MAX_LENGTH:
+        return _json_loads(arguments)
+    # deep copy, so nested values such as a coordinate list aren't shared either
+    return copy.deepcopy(_parse_short_tool_arguments(arguments))
+
+
+@dataclass(slots=True)
+class _OpenAIMessageParts:
+    """OpenAI message pieces collected from the content blocks of one Anthropic message."""
+
+    text: list[str] = field(default_factory=list)
+    content_parts: list[dict] = field(default_factory=list)
+    tool_calls: list[dict] = field(default_factory=list)
+    tool_results: list[dict] = field(default_factory=list)
+    tool_result_images: list[dict] = field(default_factory=list)
+
+
+def _add_assistant_text(block: dict, parts: _OpenAIMessageParts) -> None:
+    parts.text.append(block["text"])
+
+
+def _add_tool_call(block: dict, parts: _OpenAIMessageParts) -> None:
+    parts.tool_calls.append({
+        "id": block["id"],
+        "type": "function",
+        "function": {
+            "name": block["name"],
+            "arguments": _json_dumps(block["input"])
+        }
+    })
+
+
+def _openai_image_part(source: dict[str, Any]) -> dict[str, Any]:
+    """
+    Build an OpenAI image_url content part from an Anthropic base64 image source.
+
+    The data URL copies the whole base64 payload, so it is deliberately not cached:
+    sampling_loop converts each message once per call, and a cache would double the
+    memory held by screenshots and keep images alive after they are filtered out.
+    """
+    return {
+        "type": "image_url",
+        "image_url": {"url": f"data:{source['media_type']};base64,{source['data']}"},
+    }
+
+
+def _add_user_text(block: dict, parts: _OpenAIMessageParts) -> None:
+    parts.content_parts.append({"type": "text", "text": block["text"]})
+
+
+def _add_image(block: dict, parts: _OpenAIMessageParts) -> None:
+    parts.content_parts.append(_openai_image_part(block["source"]))
+
+
+def _add_image_url(block: dict, parts: _OpenAIMessageParts) -> None:
+    # screenshots that follow NEBIUS tool results are already converted
+    parts.content_parts.append(block)
+
+
+def _add_tool_result(block: dict, parts: _OpenAIMessageParts) -> None:
+    # Handle tool results as separate messages
+    tool_result_content = ""
+    # content is the one optional field of a tool_result block
+    block_content = block.get("content")
+
+    if isinstance(block_content, list):
+        for content_item in block_content:
+            if not isinstance(content_item, dict):
+                continue
+            item_type = content_item["type"]
+            if item_type == "text":
+                tool_result_content += content_item["text"]
+            elif item_type == "image":
+                # Images go in separate user messages after the tool results
+                parts.tool_result_images.append({
+                    "role": "user",
+                    "content": [_openai_image_part(content_item["source"])]
+                })
+    elif isinstance(block_content, str):
+        tool_result_content = block_content
+
+    parts.tool_results.append({
+        "role": "tool",
+        "tool_call_id": block["tool_use_id"],
+        "content": tool_result_content
+    })
+
+
+# Block converters keyed by content block type; blocks of any other type are dropped.
+_BlockHandler = Callable[[dict, _OpenAIMessageParts], None]
+
+_ASSISTANT_BLOCK_HANDLERS: dict[str, _BlockHandler] = {
+    "text": _add_assistant_text,
+    "tool_use": _add_tool_call,
+}
+
+_USER_BLOCK_HANDLERS: dict[str, _BlockHandler] = {
+    "text": _add_user_text,
+    "image": _add_image,
+    "image_url": _add_image_url,
+    "tool_result": _add_tool_result,
+}
+
+
+def _collect_message_parts(
+    content: list, handlers: dict[str, _BlockHandler]
+) -> _OpenAIMessageParts:
+    parts = _OpenAIMessageParts()
+    for block in content:
+        if isinstance(block, dict):
+            handler = handlers.get(block["type"])
+            if handler is not None:
+                handler(block, parts)
+    return parts
+
+
+def _append_openai_assistant_message(content: list, openai_messages: list[dict]) -> None:
+    """Convert an assistant message with content blocks, handling tool calls."""
+    parts = _collect_message_parts(content, _ASSISTANT_BLOCK_HANDLERS)
+
+    msg = {"role": "assistant"}
+    content_text = "".join(parts.text)
+    if content_text:
+        msg["content"] = content_text
+    if parts.tool_calls:
+        msg["tool_calls"] = parts.tool_calls  # type: ignore
+    openai_messages.append(msg)
+
+
+def _append_openai_user_message(content: list, openai_messages: list[dict]) -> None:
+    """Convert a user message with content blocks, handling tool results."""
+    parts = _collect_message_parts(content, _USER_BLOCK_HANDLERS)
+
+    # Add tool results first: they must directly follow the assistant tool calls
+    openai_messages.extend(parts.tool_results)
+    openai_messages.extend(parts.tool_result_images)
+
+    # Add content parts if any
+    content_parts = parts.content_parts
+    if content_parts:
+        openai_messages.append({
+            "role": "user",
+            "content": content_parts[0]["text"]
+            if len(content_parts) == 1 and content_parts[0]["type"] == "text"
+            else content_parts
+        })
+
+
+# Converters for messages whose content is a list of blocks, keyed by role.
+# Messages with plain string content are passed through for any role.
+_OPENAI_MESSAGE_CONVERTERS: dict[str, Callable[[list, list[dict]], None]] = {
+    "assistant": _append_openai_assistant_message,
+    "user": _append_openai_user_message,
+}
+
+
+def _append_anthropic_messages_to_openai(
+    openai_messages: list[dict], messages: Iterable[BetaMessageParam]
+) -> None:
+    """Convert Anthropic format messages to OpenAI format, appending them in place."""
+    # bound once: this runs over every message of the history
+    append = openai_messages.append
+    converters = _OPENAI_MESSAGE_CONVERTERS
+
+    for message in messages:
+        role = message["role"]
+        content = message["content"]
+        if role == "tool":
+            # NEBIUS tool results (see _make_nebius_tool_result) are already in
+            # OpenAI format and carry the tool_call_id and name the API expects
+            append(message)
+        elif isinstance(content, str):
+            # Simple text message
+            append({"role": role, "content": content})
+        elif convert := converters.get(role):
+            convert(content, openai_messages)
+
+
 def _convert_anthropic_messages_to_openai(messages: list[BetaMessageParam]) -> list[dict]:
     """Convert Anthropic message format to OpenAI format."""
     openai_messages = []
-    
-    for message in messages:
-        if isinstance(message["content"], str):
-            # Simple text message
-            openai_messages.append({
-                "role": message["role"],
-                "content": message["content"]
-            })
-        elif isinstance(message["content"], list):
-            # Complex message with multiple content blocks
-            if message["role"] == "assistant":
-                # Handle assistant messages with tool calls
-                tool_calls = []
-                content_text = ""
-                
-                for block in message["content"]:
-                    if isinstance(block, dict):
-                        if block.get("type") == "text":
-                            content_text += block.get("text", "")
-                        elif block.get("type") == "tool_use":
-                            tool_calls.append({
-                                "id": block["id"],
-                                "type": "function",
-                                "function": {
-                                    "name": block["name"],
-                                    "arguments": json.dumps(block["input"])
-                                }
-                            })
-                
-                msg = {"role": "assistant"}
-                if content_text:
-                    msg["content"] = content_text
-                if tool_calls:
-                    msg["tool_calls"] = tool_calls  # type: ignore
-                openai_messages.append(msg)
-                
-            elif message["role"] == "user":
-                # Handle user messages with tool results
-                content_parts = []
-                tool_results = []
-                
-                for block in message["content"]:
-                    if isinstance(block, dict):
-                        if block.get("type") == "text":
-                            content_parts.append({"type": "text", "text": block.get("text", "")})
-                        elif block.get("type") == "image":
-                            content_parts.append({
-                                "type": "image_url",
-                                "image_url": {
-                                    "url": f"data:{block['source']['media_type']};base64,{block['source']['data']}"
-                                }
-                            })
-                        elif block.get("type") == "tool_result":
-                            # Handle tool results as separate messages
-                            tool_result_content = ""
-                            has_image = False
-                            
-                            if isinstance(block.get("content"), list):
-                                for content_item in block["content"]:
-                                    if isinstance(content_item, dict):
-                                        if content_item.get("type") == "text":
-                                            tool_result_content += content_item.get("text", "")
-                                        elif content_item.get("type") == "image":
-                                            has_image = True
-                                            # Add image as separate user message
-                                            openai_messages.append({
-                                                "role": "user",
-                                                "content": [{
-                                                    "type": "image_url",
-                                                    "image_url": {
-                                                        "url": f"data:{content_item['source']['media_type']};base64,{content_item['source']['data']}"
-                                                    }
-                                                }]
-                                            })
-                            elif isinstance(block.get("content"), str):
-                                tool_result_content = block["content"]
-                            
-                            tool_results.append({
-                                "role": "tool",
-                                "tool_call_id": block["tool_use_id"],
-                                "content": tool_result_content
-                            })
-                
-                # Add tool results first
-                openai_messages.extend(tool_results)
-                
-                # Add content parts if any
-                if content_parts:
-                    openai_messages.append({
-                        "role": "user",
-                        "content": content_parts if len(content_parts) > 1 else content_parts[0].get("text", "")
-                    })
-    
+    _append_anthropic_messages_to_openai(openai_messages, messages)
     return openai_messages
 
 
-def _convert_anthropic_tools_to_openai(anthropic_tools: list) -> list[dict]:
-    """Convert Anthropic tool format to OpenAI format."""
-    
-    # Mapping of Anthropic computer use tools to OpenAI format
-    ANTHROPIC_TO_OPENAI_TOOLS = {
-        "computer": {
-            "type": "function",
-            "function": {
-                "name": "computer",
-                "description": "Take a screenshot, click, type, scroll, and perform other computer actions. This tool gives you the ability to interact with the screen, keyboard, and mouse of the current computer. USE THIS TOOL FOR SCREENSHOTS with action='screenshot'.",
-                "parameters": {
-                    "type": "object",
-                    "properties": {
-                        "action": {
-                            "type": "string",
-                            "enum": [
-                                "key", "type", "mouse_move", "left_click", "left_click_drag", 
-                                "right_click", "middle_click", "double_click", "screenshot", 
-                                "cursor_position", "left_mouse_down", "left_mouse_up", "scroll",
-                                "hold_key", "wait", "triple_click"
-                            ],
-                            "description": "The action to perform"
-                        },
-                        "text": {
-                            "type": "string",
-                            "description": "Text to type (required for 'type' action)"
-                        },
-                        "coordinate": {
-                            "type": "array",
-                            "items": {"type": "integer"},
-                            "minItems": 2,
-                            "maxItems": 2,
-                            "description": "Pixel coordinate [x, y] for mouse actions"
-                        },
-                        "scroll_direction": {
-                            "type": "string",
-                            "enum": ["up", "down", "left", "right"],
-                            "description": "Direction to scroll (for 'scroll' action)"
-                        }
+# Mapping of Anthropic computer use tools to OpenAI format. The schemas are static,
+# so they are built once at import instead of on every conversion.
+ANTHROPIC_TO_OPENAI_TOOLS = {
+    "computer": {
+        "type": "function",
+        "function": {
+            "name": "computer",
+            "description": "Take a screenshot, click, type, scroll, and perform other computer actions. This tool gives you the ability to interact with the screen, keyboard, and mouse of the current computer. USE THIS TOOL FOR SCREENSHOTS with action='screenshot'.",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "action": {
+                        "type": "string",
+                        "enum": [
+                            "key", "type", "mouse_move", "left_click", "left_click_drag",
+                            "right_click", "middle_click", "double_click", "screenshot",
+                            "cursor_position", "left_mouse_down", "left_mouse_up", "scroll",
+                            "hold_key", "wait", "triple_click"
+                        ],
+                        "description": "The action to perform"
                     },
-                    "required": ["action"]
-                }
-            }
-        },
-        "str_replace_editor": {
-            "type": "function",
-            "function": {
-                "name": "str_replace_editor",
-                "description": "A text editor tool for viewing, creating and editing TEXT FILES ONLY. Can view file contents, create new files, edit files, and perform string replacements. NEVER use for screenshots or images - use computer tool for screenshots.",
-                "parameters": {
-                    "type": "object",
-                    "properties": {
-                        "command": {
-                            "type": "string",
-                            "enum": ["view", "create", "str_replace", "undo_edit"],
-                            "description": "The command to execute"
-                        },
-                        "path": {
-                            "type": "string",
-                            "description": "Path to the file"
-                        },
-                        "file_text": {
-                            "type": "string",
-                            "description": "Text content for creating files"
-                        },
-                        "old_str": {
-                            "type": "string",
-                            "description": "String to replace (for str_replace command)"
-                        },
-                        "new_str": {
-                            "type": "string",
-                            "description": "Replacement string (for str_replace command)"
-                        }
+                    "text": {
+                        "type": "string",
+                        "description": "Text to type (required for 'type' action)"
                     },
-                    "required": ["command", "path"]
-                }
+                    "coordinate": {
+                        "type": "array",
+                        "items": {"type": "integer"},
+                        "minItems": 2,
+                        "maxItems": 2,
+                        "description": "Pixel coordinate [x, y] for mouse actions"
+                    },
+                    "scroll_direction": {
+                        "type": "string",
+                        "enum": ["up", "down", "left", "right"],
+                        "description": "Direction to scroll (for 'scroll' action)"
+                    }
+                },
+                "required": ["action"]
             }
-        },
-        "bash": {
-            "type": "function",
-            "function": {
-                "name": "bash",
-                "description": "Execute bash commands in the terminal. Can run shell commands, manage files, install software, and interact with the system.",
-                "parameters": {
-                    "type": "object",
-                    "properties": {
-                        "command": {
-                            "type": "string",
-                            "description": "The bash command to execute"
-                        }
+        }
+    },
+    "str_replace_editor": {
+        "type": "function",
+        "function": {
+            "name": "str_replace_editor",
+            "description": "A text editor tool for viewing, creating and editing TEXT FILES ONLY. Can view file contents, create new files, edit files, and perform string replacements. NEVER use for screenshots or images - use computer tool for screenshots.",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "command": {
+                        "type": "string",
+                        "enum": ["view", "create", "str_replace", "undo_edit"],
+                        "description": "The command to execute"
                     },
-                    "required": ["command"]
-                }
+                    "path": {
+                        "type": "string",
+                        "description": "Path to the file"
+                    },
+                    "file_text": {
+                        "type": "string",
+                        "description": "Text content for creating files"
+                    },
+                    "old_str": {
+                        "type": "string",
+                        "description": "String to replace (for str_replace command)"
+                    },
+                    "new_str": {
+                        "type": "string",
+                        "description": "Replacement string (for str_replace command)"
+                    }
+                },
+                "required": ["command", "path"]
             }
         }
-    }
-    
-    openai_tools = []
-    
-    for tool in anthropic_tools:
-        tool_name = tool.get("name")
-        
-        if tool_name in ANTHROPIC_TO_OPENAI_TOOLS:
-            # Use predefined mapping for computer use tools
-            openai_tools.append(ANTHROPIC_TO_OPENAI_TOOLS[tool_name])
-        else:
-            # Fallback for custom tools that might have description and input_schema
-            openai_tool = {
-                "type": "function",
-                "function": {
-                    "name": tool.get("name", "unknown"),
-                    "description": tool.get("description", ""),
-                    "parameters": tool.get("input_schema", {})
-                }
+    },
+    "bash": {
+        "type": "function",
+        "function": {
+            "name": "bash",
+            "description": "Execute bash commands in the terminal. Can run shell commands, manage files, install software, and interact with the system.",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "command": {
+                        "type": "string",
+                        "description": "The bash command to execute"
+                    }
+                },
+                "required": ["command"]
             }
-            openai_tools.append(openai_tool)
-    
-    return openai_tools
+        }
+    }
+}
+
+
+def _openai_function_tool(tool: dict) -> dict:
+    """OpenAI function tool for a custom tool described by its input_schema."""
+    return {
+        "type": "function",
+        "function": {
+            "name": tool["name"],
+            "description": tool.get("description", ""),
+            "parameters": tool.get(
+                "input_schema", {"type": "object", "properties": {}}
+            ),
+        },
+    }
+
+
+def _convert_anthropic_tools_to_openai(anthropic_tools: list) -> list[dict]:
+    """Convert Anthropic tool format to OpenAI format."""
+    # computer use tools have no input_schema, they use the predefined mapping
+    predefined = ANTHROPIC_TO_OPENAI_TOOLS
+    return [
+        predefined.get(tool["name"]) or _openai_function_tool(tool)
+        for tool in anthropic_tools
+    ]
+
+
+@functools.lru_cache(maxsize=8)
+def openai_tools_for_version(tool_version: ToolVersion) -> tuple[dict, ...]:
+    """
+    OpenAI format of the tools of a tool version, converted once per process.
+    The tool dicts are shared between callers and must not be modified.
+    """
+    tool_group = TOOL_GROUPS_BY_VERSION[tool_version]
+    tool_collection = ToolCollection(*(ToolCls() for ToolCls in tool_group.tools))
+    return tuple(_convert_anthropic_tools_to_openai(tool_collection.to_params()))
+
+
+# fetches all fields of an OpenAI tool call in one C-level call
+_TOOL_CALL_FIELDS = attrgetter("id", "function.name", "function.arguments")
 
 
 def _convert_openai_response_to_anthropic(openai_response) -> list[BetaContentBlockParam]:
@@ -272,17 +404,49 @@ def _convert_openai_response_to_anthropic(openai_response) -> list[BetaContentBl
     
     # Handle tool calls
     if choice.tool_calls:
-        for tool_call in choice.tool_calls:
-            result.append({
+        append = result.append
+        for tool_call_id, name, arguments in map(
+            _TOOL_CALL_FIELDS, choice.tool_calls
+        ):
+            tool_input = _parse_tool_arguments(arguments)
+            append({
                 "type": "tool_use",
-                "id": tool_call.id,
-                "name": tool_call.function.name,
-                "input": json.loads(tool_call.function.arguments)
+                "id": tool_call_id,
+                "name": name,
+                "input": tool_input
             })
     
     return result
 
 
+async def _stream_openai_completion(
+    client, output_callback: Callable[[BetaContentBlockParam], None], **kwargs
+) -> tuple[Any, int]:
+    """
+    Stream a chat completion and return it once complete, together with the number
+    of leading content blocks already passed to output_callback.
+
+    OpenAI-compatible models send their text before any tool calls, so the text
+    block is reported as soon as the first tool call starts arriving instead of
+    after the whole (possibly long) tool call arguments have been generated.
+    """
+    from openai.lib.streaming.chat import ChatCompletionStreamState
+
+    state = ChatCompletionStreamState()
+    streamed_blocks = 0
+    async for chunk in await client.chat.completions.create(stream=True, **kwargs):
+        state.handle_chunk(chunk)
+        if (
+            not streamed_blocks
+            and chunk.choices
+            and chunk.choices[0].delta.tool_calls
+            and (text := state.current_completion_snapshot.choices[0].message.content)
+        ):
+            output_callback(BetaTextBlockParam(type="text", text=text))
+            streamed_blocks = 1
+    return state.current_completion_snapshot, streamed_blocks
+
+
 class APIProvider(StrEnum):
     ANTHROPIC = "anthropic"
     BEDROCK = "bedrock"
@@ -324,12 +488,11 @@ def _make_nebius_tool_result(result: ToolResult, tool_call_id: str, tool_name: s
     """Convert a ToolResult to OpenAI format messages."""
     messages = []
     
-    # Create tool response message
-    tool_content = ""
-    if result.error:
-        tool_content = _maybe_prepend_system_tool_result(result, result.error)
-    elif result.output:
-        tool_content = _maybe_prepend_system_tool_result(result, result.output)
+    # Create tool response message; an error takes precedence over the output
+    result_text = result.error or result.output
+    tool_content = (
+        _maybe_prepend_system_tool_result(result, result_text) if result_text else ""
+    )
     
     messages.append({
         "role": "tool",
@@ -376,30 +539,56 @@ async def sampling_loop(
     """
     tool_group = TOOL_GROUPS_BY_VERSION[tool_version]
     tool_collection = ToolCollection(*(ToolCls() for ToolCls in tool_group.tools))
-    system = BetaTextBlockParam(
-        type="text",
-        text=f"{SYSTEM_PROMPT}{' ' + system_prompt_suffix if system_prompt_suffix else ''}",
+    system_content = (
+        f"{SYSTEM_PROMPT}{' ' + system_prompt_suffix if system_prompt_suffix else ''}"
+    )
+    system = BetaTextBlockParam(type="text", text=system_content)
+    # NEBIUS: the request messages, i.e. the system message followed by the OpenAI
+    # format of messages[:converted_upto]. They are extended every iteration with
+    # only the messages appended since, instead of reconverting the history, and
+    # the static system message stays at the head of the prompt across turns.
+    openai_messages: list[dict] = [{"role": "system", "content": system_content}]
+    converted_upto = 0
+    # tool_result images in messages, counted once and then kept up to date as
+    # results are appended and images filtered out, instead of rescanning each turn
+    image_count: int | None = None
+    # the tools don't change during the loop, so convert them once up front
+    openai_tools = (
+        _convert_anthropic_tools_to_openai(tool_collection.to_params())
+        if provider == APIProvider.NEBIUS
+        else []
     )
+    # requests sharing the tools + system prompt prefix get the same cache key, so
+    # they are routed to where that prefix is already cached
+    openai_prompt_cache_key = hashlib.sha256(
+        f"{tool_version}\n{system_content}".encode()
+    ).hexdigest()[:32]
+
+    # async clients keep the event loop free while waiting on the API; they are
+    # created once so every iteration reuses the same connection pool
+    enable_prompt_caching = False
+    client = None
+    if provider == APIProvider.ANTHROPIC:
+        client = AsyncAnthropic(api_key=api_key, max_retries=4)
+        enable_prompt_caching = True
+    elif provider == APIProvider.VERTEX:
+        client = AsyncAnthropicVertex()
+    elif provider == APIProvider.BEDROCK:
+        client = AsyncAnthropicBedrock()
+    elif provider == APIProvider.NEBIUS:
+        # imported lazily: only this provider needs the (slow to import) SDK
+        from openai import AsyncOpenAI
+
+        client = AsyncOpenAI(
+            base_url="https://api.studio.nebius.com/v1/",
+            api_key=api_key
+        )
 
     while True:
-        enable_prompt_caching = False
         betas = [tool_group.beta_flag] if tool_group.beta_flag else []
         if token_efficient_tools_beta:
             betas.append("token-efficient-tools-2025-02-19")
         image_truncation_threshold = only_n_most_recent_images or 0
-        client = None
-        if provider == APIProvider.ANTHROPIC:
-            client = Anthropic(api_key=api_key, max_retries=4)
-            enable_prompt_caching = True
-        elif provider == APIProvider.VERTEX:
-            client = AnthropicVertex()
-        elif provider == APIProvider.BEDROCK:
-            client = AnthropicBedrock()
-        elif provider == APIProvider.NEBIUS:
-            client = OpenAI(
-                base_url="https://api.studio.nebius.com/v1/",
-                api_key=api_key
-            )
 
         if enable_prompt_caching:
             betas.append(PROMPT_CACHING_BETA_FLAG)
@@ -411,11 +600,18 @@ async def sampling_loop(
             system["cache_control"] = {"type": "ephemeral"}  # type: ignore
 
         if only_n_most_recent_images:
-            _maybe_filter_to_n_most_recent_images(
+            if image_count is None:
+                image_count = _count_images(messages)
+            if removed := _maybe_filter_to_n_most_recent_images(
                 messages,
                 only_n_most_recent_images,
                 min_removal_threshold=image_truncation_threshold,
-            )
+                total_images=image_count,
+            ):
+                image_count -= removed
+                # earlier messages changed, the converted history is stale
+                del openai_messages[1:]
+                converted_upto = 0
         extra_body = {}
         if thinking_budget:
             # Ensure we only send the required fields for thinking
@@ -429,20 +625,22 @@ async def sampling_loop(
         # `response = client.messages.create(...)` instead.
         try:
             if provider == APIProvider.NEBIUS:
-                # Convert messages and tools to OpenAI format
-                openai_messages = _convert_anthropic_messages_to_openai(messages)
-                openai_tools = _convert_anthropic_tools_to_openai(tool_collection.to_params())
-                
-                # Add system message at the beginning for OpenAI
-                system_content = f"{SYSTEM_PROMPT}{' ' + system_prompt_suffix if system_prompt_suffix else ''}"
-                openai_messages.insert(0, {"role": "system", "content": system_content})
+                # Convert new messages and tools to OpenAI format
+                _append_anthropic_messages_to_openai(
+                    openai_messages, messages[converted_upto:]
+                )
+                converted_upto = len(messages)
                 
-                response = client.chat.completions.create(
+                response, streamed_blocks = await _stream_openai_completion(
+                    client,
+                    output_callback,
                     model=model,
                     messages=openai_messages,
                     tools=openai_tools if openai_tools else None,
                     tool_choice="required",
-                    max_tokens=max_tokens
+                    max_tokens=max_tokens,
+                    # sent as a raw field: older openai SDKs don't accept the kwarg
+                    extra_body={"prompt_cache_key": openai_prompt_cache_key},
                 )
 
                 
@@ -461,7 +659,7 @@ async def sampling_loop(
                 raw_response = MockRawResponse(response)
             else:
                 # Original Anthropic API call
-                raw_response = client.beta.messages.with_raw_response.create(
+                raw_response = await client.beta.messages.with_raw_response.create(
                     max_tokens=max_tokens,
                     messages=messages,
                     model=model,
@@ -470,6 +668,7 @@ async def sampling_loop(
                     betas=betas,
                     extra_body=extra_body,
                 )
+                streamed_blocks = 0
         except (APIStatusError, APIResponseValidationError) as e:
             api_response_callback(e.request, e.response, e)
             return messages
@@ -515,100 +714,139 @@ async def sampling_loop(
 
         tool_result_content: list[BetaToolResultBlockParam] = []
         nebius_tool_messages: list[dict] = []
-        
-        for content_block in response_params:
-            output_callback(content_block)
+        nebius_image_messages: list[dict] = []
+
+        for index, content_block in enumerate(response_params):
+            if index >= streamed_blocks:
+                output_callback(content_block)
             if content_block["type"] == "tool_use":
                 result = await tool_collection.run(
                     name=content_block["name"],
                     tool_input=cast(dict[str, Any], content_block["input"]),
                 )
-                
+
                 if provider == APIProvider.NEBIUS:
-                    # For Nebius, collect tool result messages
-                    tool_messages = _make_nebius_tool_result(
-                        result, 
-                        content_block["id"], 
+                    # For Nebius, collect tool result messages; screenshots are kept
+                    # apart so that every tool message directly follows the tool calls
+                    tool_message, *image_messages = _make_nebius_tool_result(
+                        result,
+                        content_block["id"],
                         content_block["name"]
                     )
-                    nebius_tool_messages.extend(tool_messages)
+                    nebius_tool_messages.append(tool_message)
+                    nebius_image_messages.extend(image_messages)
                 else:
                     # For Anthropic, use original format
                     tool_result_content.append(
                         _make_api_tool_result(result, content_block["id"])
                     )
-                
+
                 tool_output_callback(result, content_block["id"])
 
         if provider == APIProvider.NEBIUS:
             if nebius_tool_messages:
                 # For Nebius, extend the messages list with tool results
                 messages.extend(nebius_tool_messages)
+                messages.extend(nebius_image_messages)
             else:
                 return messages
         else:
             if not tool_result_content:
                 return messages
             messages.append({"content": tool_result_content, "role": "user"})
+            if image_count is not None:
+                image_count += _count_tool_result_images(tool_result_content)
+
+
+def _count_tool_result_images(content: list) -> int:
+    """Count the images inside the tool_result blocks of one message's content."""
+    total_images = 0
+    for item in content:
+        if isinstance(item, dict) and item["type"] == "tool_result":
+            if isinstance(tool_result_content := item.get("content"), list):
+                total_images += sum(
+                    1
+                    for content in tool_result_content
+                    if isinstance(content, dict) and content["type"] == "image"
+                )
+    return total_images
+
+
+def _count_images(messages: list[BetaMessageParam]) -> int:
+    return sum(
+        _count_tool_result_images(message_content)
+        for message in messages
+        if isinstance(message_content := message["content"], list)
+    )
 
 
 def _maybe_filter_to_n_most_recent_images(
     messages: list[BetaMessageParam],
     images_to_keep: int,
     min_removal_threshold: int,
-):
+    total_images: int | None = None,
+) -> int:
     """
     With the assumption that images are screenshots that are of diminishing value as
     the conversation progresses, remove all but the final `images_to_keep` tool_result
     images in place, with a chunk of min_removal_threshold to reduce the amount we
-    break the implicit prompt cache.
+    break the implicit prompt cache. Returns the number of images removed.
+
+    `total_images` is the number of tool_result images currently in `messages`, if
+    the caller keeps track of it; otherwise the history is scanned to count them.
     """
     if images_to_keep is None:
-        return messages
-
-    tool_result_blocks = cast(
-        list[BetaToolResultBlockParam],
-        [
-            item
-            for message in messages
-            for item in (
-                message["content"] if isinstance(message["content"], list) else []
-            )
-            if isinstance(item, dict) and item.get("type") == "tool_result"
-        ],
-    )
+        return 0
 
-    total_images = sum(
-        1
-        for tool_result in tool_result_blocks
-        for content in tool_result.get("content", [])
-        if isinstance(content, dict) and content.get("type") == "image"
-    )
+    if total_images is None:
+        total_images = _count_images(messages)
 
     images_to_remove = total_images - images_to_keep
     # for better cache behavior, we want to remove in chunks
     images_to_remove -= images_to_remove % min_removal_threshold
+    if images_to_remove <= 0:
+        # steady state: still under the cap, leave the tool results untouched
+        return 0
+    removed = images_to_remove
 
-    for tool_result in tool_result_blocks:
-        if isinstance(tool_result.get("content"), list):
+    for message in messages:
+        if not isinstance(message_content := message["content"], list):
+            continue
+        for item in message_content:
+            if not (isinstance(item, dict) and item["type"] == "tool_result"):
+                continue
+            tool_result = cast(BetaToolResultBlockParam, item)
+            if not isinstance(tool_result_content := tool_result.get("content"), list):
+                continue
             new_content = []
-            for content in tool_result.get("content", []):
-                if isinstance(content, dict) and content.get("type") == "image":
-                    if images_to_remove > 0:
-                        images_to_remove -= 1
-                        continue
+            for content in tool_result_content:
+                if (
+                    images_to_remove
+                    and isinstance(content, dict)
+                    and content["type"] == "image"
+                ):
+                    images_to_remove -= 1
+                    continue
                 new_content.append(content)
-            tool_result["content"] = new_content
+            # only tool results that lost an image get a new content list
+            if len(new_content) != len(tool_result_content):
+                tool_result["content"] = new_content
+            if not images_to_remove:
+                # images are removed oldest first, the rest of the history is kept
+                return removed
+    # fewer images than total_images claimed: report only the ones actually removed
+    return removed - images_to_remove
 
 
 def _response_to_params(
     response: BetaMessage,
 ) -> list[BetaContentBlockParam]:
     res: list[BetaContentBlockParam] = []
+    append = res.append
     for block in response.content:
         if isinstance(block, BetaTextBlock):
             if block.text:
-                res.append(BetaTextBlockParam(type="text", text=block.text))
+                append({"type": "text", "text": block.text})
             elif getattr(block, "type", None) == "thinking":
                 # Handle thinking blocks - include signature field
                 thinking_block = {
@@ -617,10 +855,11 @@ def _response_to_params(
                 }
                 if hasattr(block, "signature"):
                     thinking_block["signature"] = getattr(block, "signature", None)
-                res.append(cast(BetaContentBlockParam, thinking_block))
+                append(cast(BetaContentBlockParam, thinking_block))
         else:
-            # Handle tool use blocks normally
-            res.append(cast(BetaToolUseBlockParam, block.model_dump()))
+            # Handle tool use blocks normally; unset optional fields are left out
+            # rather than sent back to the API as nulls
+            append(cast(BetaToolUseBlockParam, block.model_dump(exclude_none=True)))
     return res
 
 
@@ -653,12 +892,11 @@ def _make_api_tool_result(
     result: ToolResult, tool_use_id: str
 ) -> BetaToolResultBlockParam:
     """Convert an agent ToolResult to an API ToolResultBlockParam."""
-    tool_result_content: list[BetaTextBlockParam | BetaImageBlockParam] | str = []
-    is_error = False
+    tool_result_content: list[BetaTextBlockParam | BetaImageBlockParam] | str
     if result.error:
-        is_error = True
         tool_result_content = _maybe_prepend_system_tool_result(result, result.error)
     else:
+        tool_result_content = []
         if result.output:
             tool_result_content.append(
                 {
@@ -681,11 +919,10 @@ def _make_api_tool_result(
         "type": "tool_result",
         "content": tool_result_content,
         "tool_use_id": tool_use_id,
-        "is_error": is_error,
+        "is_error": bool(result.error),
     }
 
 
-def _maybe_prepend_system_tool_result(result: ToolResult, result_text: str):
-    if result.system:
-        result_text = f"<system>{result.system}</system>\n{result_text}"
-    return result_text
+def _maybe_prepend_system_tool_result(result: ToolResult, result_text: str) -> str:
+    system = result.system
+    return f"<system>{system}</system>\n{result_text}" if system else result_text
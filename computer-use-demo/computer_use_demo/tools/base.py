@@ -20,7 +20,7 @@ class BaseAnthropicTool(metaclass=ABCMeta):
         raise NotImplementedError
 
 
-@dataclass(kw_only=True, frozen=True)
+@dataclass(kw_only=True, frozen=True, slots=True)
 class ToolResult:
     """Represents the result of a tool execution."""
 
@@ -57,10 +57,14 @@ class ToolResult:
 class CLIResult(ToolResult):
     """A ToolResult that can be rendered as a CLI output."""
 
+    __slots__ = ()
+
 
 class ToolFailure(ToolResult):
     """A ToolResult that represents a failure."""
 
+    __slots__ = ()
+
 
 class ToolError(Exception):
     """Raised when a tool encounters an error."""
@@ -18,11 +18,16 @@ class ToolCollection:
     def __init__(self, *tools: BaseAnthropicTool):
         self.tools = tools
         self.tool_map = {tool.to_params()["name"]: tool for tool in tools}
+        self._params: list[BetaToolUnionParam] | None = None
 
     def to_params(
         self,
     ) -> list[BetaToolUnionParam]:
-        return [tool.to_params() for tool in self.tools]
+        # the tools are fixed at construction, so their params are built only once;
+        # callers get a shallow copy so the cached list itself can't be mutated
+        if self._params is None:
+            self._params = [tool.to_params() for tool in self.tools]
+        return list(self._params)
 
     async def run(self, *, name: str, tool_input: dict[str, Any]) -> ToolResult:
         tool = self.tool_map.get(name)
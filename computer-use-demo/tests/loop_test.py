@@ -1,13 +1,24 @@
+import asyncio
+from typing import cast
 from unittest import mock
 
 from anthropic.types import TextBlock, ToolUseBlock
 from anthropic.types.beta import BetaMessage, BetaMessageParam, BetaTextBlockParam
+from openai.types.chat import ChatCompletionChunk
 
-from computer_use_demo.loop import APIProvider, sampling_loop
+from computer_use_demo.loop import (
+    APIProvider,
+    _convert_anthropic_messages_to_openai,
+    _convert_openai_response_to_anthropic,
+    _maybe_filter_to_n_most_recent_images,
+    openai_tools_for_version,
+    sampling_loop,
+)
 
 
 async def test_loop():
     client = mock.Mock()
+    client.beta.messages.with_raw_response.create = mock.AsyncMock()
     client.beta.messages.with_raw_response.create.return_value = mock.Mock()
     client.beta.messages.with_raw_response.create.return_value.parse.side_effect = [
         mock.Mock(
@@ -32,7 +43,7 @@ async def test_loop():
     api_response_callback = mock.Mock()
 
     with mock.patch(
-        "computer_use_demo.loop.Anthropic", return_value=client
+        "computer_use_demo.loop.AsyncAnthropic", return_value=client
     ), mock.patch(
         "computer_use_demo.loop.ToolCollection", return_value=tool_collection
     ):
@@ -60,8 +71,408 @@ async def test_loop():
             name="computer", tool_input={"action": "test"}
         )
         output_callback.assert_called_with(
-            BetaTextBlockParam(text="Done!", type="text", citations=None)
+            BetaTextBlockParam(text="Done!", type="text")
         )
         assert output_callback.call_count == 3
         assert tool_output_callback.call_count == 1
         assert api_response_callback.call_count == 2
+
+
+def test_convert_anthropic_messages_to_openai():
+    tool_input = {"action": "screenshot"}
+    messages: list[BetaMessageParam] = [
+        {"role": "user", "content": "Test message"},
+        {
+            "role": "assistant",
+            "content": [
+                {"type": "text", "text": "Taking a screenshot"},
+                {
+                    "type": "tool_use",
+                    "id": "call_1",
+                    "name": "computer",
+                    "input": tool_input,
+                },
+            ],
+        },
+        {
+            "role": "user",
+            "content": [
+                {
+                    "type": "tool_result",
+                    "tool_use_id": "call_1",
+                    "content": [
+                        {"type": "text", "text": "Tool output"},
+                        {
+                            "type": "image",
+                            "source": {
+                                "type": "base64",
+                                "media_type": "image/png",
+                                "data": "aW1n",
+                            },
+                        },
+                    ],
+                }
+            ],
+        },
+    ]
+
+    expected = [
+        {"role": "user", "content": "Test message"},
+        {
+            "role": "assistant",
+            "content": "Taking a screenshot",
+            "tool_calls": [
+                {
+                    "id": "call_1",
+                    "type": "function",
+                    "function": {
+                        "name": "computer",
+                        "arguments": '{"action":"screenshot"}',
+                    },
+                }
+            ],
+        },
+        {"role": "tool", "tool_call_id": "call_1", "content": "Tool output"},
+        {
+            "role": "user",
+            "content": [
+                {
+                    "type": "image_url",
+                    "image_url": {"url": "data:image/png;base64,aW1n"},
+                }
+            ],
+        },
+    ]
+    assert _convert_anthropic_messages_to_openai(messages) == expected
+
+
+def test_convert_keeps_nebius_tool_results():
+    tool_message = {
+        "role": "tool",
+        "tool_call_id": "call_1",
+        "name": "computer",
+        "content": "Tool output",
+    }
+    image_message = {
+        "role": "user",
+        "content": [
+            {
+                "type": "image_url",
+                "image_url": {"url": "data:image/png;base64,aW1n"},
+            }
+        ],
+    }
+
+    assert _convert_anthropic_messages_to_openai(
+        cast(list[BetaMessageParam], [tool_message, image_message])
+    ) == [tool_message, image_message]
+
+
+def test_convert_openai_response_to_anthropic():
+    tool_calls = [
+        mock.Mock(
+            id=f"call_{i}",
+            function=mock.Mock(arguments='{"action":"left_click","coordinate":[1,2]}'),
+        )
+        for i in range(2)
+    ]
+    for tool_call in tool_calls:
+        tool_call.function.name = "computer"
+    message = mock.Mock(content="Hello", tool_calls=tool_calls)
+    response = mock.Mock(choices=[mock.Mock(message=message)])
+
+    result = _convert_openai_response_to_anthropic(response)
+
+    assert result == [
+        {"type": "text", "text": "Hello"},
+        {
+            "type": "tool_use",
+            "id": "call_0",
+            "name": "computer",
+            "input": {"action": "left_click", "coordinate": [1, 2]},
+        },
+        {
+            "type": "tool_use",
+            "id": "call_1",
+            "name": "computer",
+            "input": {"action": "left_click", "coordinate": [1, 2]},
+        },
+    ]
+    # identical arguments are parsed once but every block owns its input
+    assert result[1]["input"] is not result[2]["input"]
+    assert result[1]["input"]["coordinate"] is not result[2]["input"]["coordinate"]
+
+
+async def test_loop_nebius():
+    def completion_stream(*deltas):
+        async def stream():
+            for index, delta in enumerate(deltas):
+                yield ChatCompletionChunk.model_validate(
+                    {
+                        "id": "chunk",
+                        "object": "chat.completion.chunk",
+                        "created": 0,
+                        "model": "test-model",
+                        "choices": [
+                            {
+                                "index": 0,
+                                "delta": delta,
+                                "finish_reason": "stop"
+                                if index == len(deltas) - 1
+                                else None,
+                            }
+                        ],
+                    }
+                )
+
+        return stream()
+
+    tool_call_delta = {
+        "index": 0,
+        "id": "call_1",
+        "type": "function",
+        "function": {"name": "computer", "arguments": '{"action":'},
+    }
+    client = mock.Mock()
+    client.chat.completions.create = mock.AsyncMock()
+    second_tool_call_delta = {
+        "index": 1,
+        "id": "call_2",
+        "type": "function",
+        "function": {"name": "bash", "arguments": '{"command":"ls"}'},
+    }
+    client.chat.completions.create.side_effect = [
+        completion_stream(
+            {"role": "assistant", "content": "Taking "},
+            {"content": "a screenshot"},
+            {"tool_calls": [tool_call_delta]},
+            {"tool_calls": [{"index": 0, "function": {"arguments": '"screenshot"}'}}]},
+            {"tool_calls": [second_tool_call_delta]},
+        ),
+        completion_stream({"role": "assistant", "content": "Done!"}),
+    ]
+    output_callback = mock.Mock()
+
+    tool_collection = mock.AsyncMock()
+    tool_collection.to_params = mock.Mock(return_value=[])
+    tool_collection.run.side_effect = [
+        mock.Mock(output="Tool output", error=None, base64_image="image", system=None),
+        mock.Mock(output="file.txt", error=None, base64_image=None, system=None),
+    ]
+
+    with mock.patch("openai.AsyncOpenAI", return_value=client), mock.patch(
+        "computer_use_demo.loop.ToolCollection", return_value=tool_collection
+    ):
+        messages: list[BetaMessageParam] = [{"role": "user", "content": "Test message"}]
+        result = await sampling_loop(
+            model="test-model",
+            provider=APIProvider.NEBIUS,
+            system_prompt_suffix="",
+            messages=messages,
+            output_callback=output_callback,
+            tool_output_callback=mock.Mock(),
+            api_response_callback=mock.Mock(),
+            api_key="test-key",
+            tool_version="computer_use_20250124",
+        )
+
+    # the text is reported while the tool call streams in, and only once
+    assert [call.args[0]["type"] for call in output_callback.call_args_list] == [
+        "text",
+        "tool_use",
+        "tool_use",
+        "text",
+    ]
+    assert output_callback.call_args_list[0].args[0]["text"] == "Taking a screenshot"
+    # every tool message directly follows the tool calls, the screenshot comes after
+    assert [message["role"] for message in result] == [
+        "user",
+        "assistant",
+        "tool",
+        "tool",
+        "user",
+        "assistant",
+    ]
+    assert client.chat.completions.create.call_count == 2
+    first_call, second_call = client.chat.completions.create.call_args_list
+    prompt_cache_key = first_call.kwargs["extra_body"]["prompt_cache_key"]
+    assert second_call.kwargs["extra_body"]["prompt_cache_key"] == prompt_cache_key
+    second_call_messages = client.chat.completions.create.call_args.kwargs["messages"]
+    assert second_call_messages[0]["role"] == "system"
+    assert second_call_messages[1:] == [
+        {"role": "user", "content": "Test message"},
+        {
+            "role": "assistant",
+            "content": "Taking a screenshot",
+            "tool_calls": [
+                {
+                    "id": "call_1",
+                    "type": "function",
+                    "function": {
+                        "name": "computer",
+                        "arguments": '{"action":"screenshot"}',
+                    },
+                },
+                {
+                    "id": "call_2",
+                    "type": "function",
+                    "function": {"name": "bash", "arguments": '{"command":"ls"}'},
+                },
+            ],
+        },
+        {
+            "role": "tool",
+            "tool_call_id": "call_1",
+            "name": "computer",
+            "content": "Tool output",
+        },
+        {
+            "role": "tool",
+            "tool_call_id": "call_2",
+            "name": "bash",
+            "content": "file.txt",
+        },
+        {
+            "role": "user",
+            "content": [
+                {
+                    "type": "image_url",
+                    "image_url": {"url": "data:image/png;base64,image"},
+                }
+            ],
+        },
+    ]
+
+
+def test_maybe_filter_to_n_most_recent_images():
+    def tool_result_message(*image_names: str) -> BetaMessageParam:
+        return {
+            "role": "user",
+            "content": [
+                {
+                    "type": "tool_result",
+                    "tool_use_id": "call",
+                    "content": [
+                        {"type": "text", "text": "Tool output"},
+                        *(
+                            {
+                                "type": "image",
+                                "source": {
+                                    "type": "base64",
+                                    "media_type": "image/png",
+                                    "data": name,
+                                },
+                            }
+                            for name in image_names
+                        ),
+                    ],
+                }
+            ],
+        }
+
+    def remaining_images(messages: list[BetaMessageParam]) -> list[str]:
+        return [
+            item["source"]["data"]
+            for message in messages
+            for block in message["content"]
+            if isinstance(block, dict)
+            for item in block["content"]
+            if item["type"] == "image"
+        ]
+
+    messages = [tool_result_message("1", "2"), tool_result_message("3")]
+    untouched_content = messages[0]["content"][0]["content"]  # type: ignore
+
+    assert _maybe_filter_to_n_most_recent_images(messages, 2, 2) == 0
+    assert messages[0]["content"][0]["content"] is untouched_content  # type: ignore
+
+    messages.append(tool_result_message("4", "5"))
+    kept_content = messages[1]["content"][0]["content"]  # type: ignore
+    assert _maybe_filter_to_n_most_recent_images(messages, 2, 2) == 2
+    assert remaining_images(messages) == ["3", "4", "5"]
+    assert messages[1]["content"][0]["content"] is kept_content  # type: ignore
+
+    # a count kept by the caller is used instead of rescanning the history
+    assert _maybe_filter_to_n_most_recent_images(messages, 2, 2, total_images=3) == 0
+    assert _maybe_filter_to_n_most_recent_images(messages, 1, 2, total_images=3) == 2
+    assert remaining_images(messages) == ["5"]
+    # an overstated count never inflates the number reported as removed
+    assert _maybe_filter_to_n_most_recent_images(messages, 0, 1, total_images=3) == 1
+    assert remaining_images(messages) == []
+
+
+async def test_loop_runs_tool_calls_in_turn():
+    events = []
+
+    async def run(*, name, tool_input):
+        events.append(("start", name))
+        await asyncio.sleep(0)
+        events.append(("end", name))
+        return mock.Mock(output="Tool output", error=None, base64_image=None, system=None)
+
+    client = mock.Mock()
+    client.beta.messages.with_raw_response.create = mock.AsyncMock()
+    client.beta.messages.with_raw_response.create.return_value = mock.Mock()
+    client.beta.messages.with_raw_response.create.return_value.parse.side_effect = [
+        mock.Mock(
+            spec=BetaMessage,
+            content=[
+                ToolUseBlock(
+                    type="tool_use",
+                    id="1",
+                    name="str_replace_editor",
+                    input={"command": "create"},
+                ),
+                ToolUseBlock(type="tool_use", id="2", name="bash", input={"command": "ls"}),
+            ],
+        ),
+        mock.Mock(spec=BetaMessage, content=[TextBlock(type="text", text="Done!")]),
+    ]
+    tool_collection = mock.Mock(run=run)
+
+    def output_callback(block):
+        events.append(("output", block.get("name", block["type"])))
+
+    def tool_output_callback(result, tool_use_id):
+        events.append(("tool_output", tool_use_id))
+
+    with mock.patch(
+        "computer_use_demo.loop.AsyncAnthropic", return_value=client
+    ), mock.patch(
+        "computer_use_demo.loop.ToolCollection", return_value=tool_collection
+    ):
+        await sampling_loop(
+            model="test-model",
+            provider=APIProvider.ANTHROPIC,
+            system_prompt_suffix="",
+            messages=[{"role": "user", "content": "Test message"}],
+            output_callback=output_callback,
+            tool_output_callback=tool_output_callback,
+            api_response_callback=mock.Mock(),
+            api_key="test-key",
+            tool_version="computer_use_20250124",
+        )
+
+    # each call is reported, run and its result shown before the next one starts
+    assert events == [
+        ("output", "str_replace_editor"),
+        ("start", "str_replace_editor"),
+        ("end", "str_replace_editor"),
+        ("tool_output", "1"),
+        ("output", "bash"),
+        ("start", "bash"),
+        ("end", "bash"),
+        ("tool_output", "2"),
+        ("output", "text"),
+    ]
+
+
+def test_openai_tools_for_version():
+    tools = openai_tools_for_version("computer_use_20250124")
+
+    assert [tool["function"]["name"] for tool in tools] == [
+        "computer",
+        "str_replace_editor",
+        "bash",
+    ]
+    assert openai_tools_for_version("computer_use_20250124") is tools
@@ -2,6 +2,8 @@
 
 """
 Advanced test using project infrastructure to test tool_choice=None behavior.
+
+Run from computer-use-demo with: python -m tests.test_advanced_tool_choice_none
 """
 
 import asyncio
@@ -10,20 +12,59 @@ import os
 import sys
 from typing import Any, Dict, List
 
-# Add the project path to Python path
-sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+import pytest
 
-from computer_use_demo.tools.nebius_collection import NebiusToolCollection
-from computer_use_demo.tools.nebius_adapter import convert_tool_classes_to_nebius
-from computer_use_demo.tools.groups import TOOL_GROUPS_BY_VERSION
-from computer_use_demo.tools.bash import BashTool20250124
-from computer_use_demo.tools.edit import EditTool20250124
+from computer_use_demo.loop import openai_tools_for_version
 try:
-    from openai import OpenAI
+    from openai import AsyncOpenAI, DefaultAsyncHttpxClient
 except ImportError:
     print("⚠️ OpenAI package not found. Please install it with: pip install openai")
     sys.exit(1)
 
+try:
+    import h2  # noqa: F401  (lets httpx speak HTTP/2, pinned in dev-requirements.txt)
+
+    HTTP2 = True
+except ImportError:
+    HTTP2 = False
+
+
+async def run_one(client: AsyncOpenAI, model: str, test_case: Dict[str, str], tools: List[Dict[str, Any]]) -> List[str]:
+    """Send one test case to one model, returning the report lines to print"""
+    lines = [
+        f"\n📝 Test: {test_case['name']}",
+        f"💬 Message: {test_case['message']}",
+        f"🎯 Expected: {test_case['expected_behavior']}",
+    ]
+
+    try:
+        response = await client.chat.completions.create(
+            model=model,
+            messages=[
+                {"role": "user", "content": test_case["message"]}
+            ],
+            max_tokens=1000,
+            tools=tools,
+            tool_choice=None  # Key parameter being tested
+        )
+
+        message = response.choices[0].message
+
+        lines.append(f"✅ Response: {message.content}")
+
+        if message.tool_calls:
+            lines.append(f"🔧 Used {len(message.tool_calls)} tool(s):")
+            for tool_call in message.tool_calls:
+                lines.append(f"   - {tool_call.function.name}: {tool_call.function.arguments}")
+        else:
+            lines.append("🚫 No tools used")
+
+    except Exception as e:
+        lines.append(f"❌ Error: {str(e)}")
+
+    lines.append("")
+    return lines
+
 
 async def test_with_project_tools():
     """Test using the project's tool infrastructure"""
@@ -31,20 +72,25 @@ async def test_with_project_tools():
     print("🔬 Advanced test with project tools")
     print("=" * 50)
     
-    # Get API key
+    # Get API key; never prompt for it, so unattended runs can't hang
     api_key = os.getenv("NEBIUS_API_KEY")
     if not api_key:
-        api_key = input("Enter your Nebius API key: ").strip()
+        pytest.skip("NEBIUS_API_KEY not set")
+
+    # Set required environment variables for computer tool
+    os.environ.setdefault("WIDTH", "1920")
+    os.environ.setdefault("HEIGHT", "1080")
     
-    # Create tool collection using project infrastructure
-    tool_group = TOOL_GROUPS_BY_VERSION["computer_use_20250124"]
-    nebius_tools = convert_tool_classes_to_nebius(tool_group.tools)
-    tool_collection = NebiusToolCollection(*nebius_tools)
+    # Convert the project's tools the same way the NEBIUS provider does;
+    # the same tools are sent with every request
+    tools = list(openai_tools_for_version("computer_use_20250124"))
     
     # Initialize client
-    client = OpenAI(
+    # the requests below all run at once; over HTTP/2 they share one connection
+    client = AsyncOpenAI(
         base_url="https://api.studio.nebius.com/v1/",
-        api_key=api_key
+        api_key=api_key,
+        http_client=DefaultAsyncHttpxClient(http2=HTTP2)
     )
     
     # Test scenarios
@@ -76,44 +122,29 @@ async def test_with_project_tools():
         "Qwen/Qwen2.5-72B-Instruct"
     ]
     
-    for model in models:
+    # All model/test case requests run at once; run_one reports errors itself, so
+    # one failing request doesn't cancel the others in the group. Leaving the
+    # client's context closes its pooled connections
+    async with client, asyncio.TaskGroup() as tg:
+        tasks = {
+            model: [
+                tg.create_task(run_one(client, model, test_case, tools))
+                for test_case in test_cases
+            ]
+            for model in models
+        }
+
+    for model, model_tasks in tasks.items():
         print(f"\n🤖 Testing model: {model}")
         print("-" * 40)
         
-        for test_case in test_cases:
-            print(f"\n📝 Test: {test_case['name']}")
-            print(f"💬 Message: {test_case['message']}")
-            print(f"🎯 Expected: {test_case['expected_behavior']}")
-            
-            try:
-                tools = tool_collection.to_params()
-                
-                response = client.chat.completions.create(
-                    model=model,
-                    messages=[
-                        {"role": "user", "content": test_case["message"]}
-                    ],
-                    max_tokens=1000,
-                    tools=tools,
-                    tool_choice=None  # Key parameter being tested
-                )
-                
-                message = response.choices[0].message
-                
-                print(f"✅ Response: {message.content}")
-                
-                if message.tool_calls:
-                    print(f"🔧 Used {len(message.tool_calls)} tool(s):")
-                    for tool_call in message.tool_calls:
-                        print(f"   - {tool_call.function.name}: {tool_call.function.arguments}")
-                else:
-                    print("🚫 No tools used")
-                    
-            except Exception as e:
-                print(f"❌ Error: {str(e)}")
-            
-            print()
-
+        for task in model_tasks:
+            print("\n".join(task.result()))
 
 if __name__ == "__main__":
+    if not os.getenv("NEBIUS_API_KEY"):
+        # every request would fail with 401, don't send any
+        print("SKIP: NEBIUS_API_KEY not set")
+        sys.exit(0)
+
     asyncio.run(test_with_project_tools())
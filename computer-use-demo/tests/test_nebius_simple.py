@@ -2,14 +2,37 @@
 
 """
 Simple test to understand Nebius Mistral model tool behavior
+
+Run from computer-use-demo with: python -m tests.test_nebius_simple
 """
 
-import sys
 import os
+import sys
 from openai import OpenAI
 
-# Add path to import computer_use_demo modules
-sys.path.append(os.path.join(os.path.dirname(__file__), 'computer_use_demo'))
+# Simple calculator tool and prompt shared by the tool tests
+CALCULATOR_TOOLS = [{
+    "type": "function",
+    "function": {
+        "name": "calculate",
+        "description": "Perform basic arithmetic calculations",
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "expression": {
+                    "type": "string",
+                    "description": "Mathematical expression to evaluate"
+                }
+            },
+            "required": ["expression"]
+        }
+    }
+}]
+
+CALCULATOR_MESSAGES = [
+    {"role": "system", "content": "You are a calculator assistant."},
+    {"role": "user", "content": "What is 2 + 3?"}
+]
 
 def setup_client():
     """Setup Nebius OpenAI client"""
@@ -23,11 +46,11 @@ def setup_client():
         api_key=api_key
     )
 
-def test_without_tools():
+def test_without_tools(client: OpenAI | None = None):
     """Test simple conversation without tools"""
     print("🔍 Testing without tools")
     
-    client = setup_client()
+    client = client or setup_client()
     if not client:
         return
     
@@ -50,43 +73,19 @@ def test_without_tools():
     except Exception as e:
         print(f"❌ Error without tools: {e}")
 
-def test_with_tools_no_choice():
+def test_with_tools_no_choice(client: OpenAI | None = None):
     """Test with tools but no tool_choice parameter"""
     print("\n🔍 Testing with tools, no tool_choice parameter")
     
-    client = setup_client()
+    client = client or setup_client()
     if not client:
         return
     
-    # Simple calculator tool
-    tools = [{
-        "type": "function",
-        "function": {
-            "name": "calculate",
-            "description": "Perform basic arithmetic calculations",
-            "parameters": {
-                "type": "object",
-                "properties": {
-                    "expression": {
-                        "type": "string",
-                        "description": "Mathematical expression to evaluate"
-                    }
-                },
-                "required": ["expression"]
-            }
-        }
-    }]
-    
-    messages = [
-        {"role": "system", "content": "You are a calculator assistant."},
-        {"role": "user", "content": "What is 2 + 3?"}
-    ]
-    
     try:
         response = client.chat.completions.create(
             model="mistralai/Mistral-Small-3.1-24B-Instruct-2503",
-            messages=messages,
-            tools=tools,
+            messages=CALCULATOR_MESSAGES,
+            tools=CALCULATOR_TOOLS,
             max_tokens=512
         )
         
@@ -102,43 +101,19 @@ def test_with_tools_no_choice():
     except Exception as e:
         print(f"❌ Error with tools (no tool_choice): {e}")
 
-def test_with_specific_tool():
+def test_with_specific_tool(client: OpenAI | None = None):
     """Test with specific tool choice"""
     print("\n🔍 Testing with specific tool choice")
     
-    client = setup_client()
+    client = client or setup_client()
     if not client:
         return
     
-    # Simple calculator tool
-    tools = [{
-        "type": "function",
-        "function": {
-            "name": "calculate",
-            "description": "Perform basic arithmetic calculations",
-            "parameters": {
-                "type": "object",
-                "properties": {
-                    "expression": {
-                        "type": "string",
-                        "description": "Mathematical expression to evaluate"
-                    }
-                },
-                "required": ["expression"]
-            }
-        }
-    }]
-    
-    messages = [
-        {"role": "system", "content": "You are a calculator assistant."},
-        {"role": "user", "content": "What is 2 + 3?"}
-    ]
-    
     try:
         response = client.chat.completions.create(
             model="mistralai/Mistral-Small-3.1-24B-Instruct-2503",
-            messages=messages,
-            tools=tools,
+            messages=CALCULATOR_MESSAGES,
+            tools=CALCULATOR_TOOLS,
             tool_choice={
                 "type": "function",
                 "function": {"name": "calculate"}
@@ -159,11 +134,18 @@ def test_with_specific_tool():
         print(f"❌ Error with specific tool choice: {e}")
 
 if __name__ == "__main__":
+    if not os.getenv("NEBIUS_API_KEY"):
+        # every request would fail with 401, don't send any
+        print("SKIP: NEBIUS_API_KEY not set")
+        sys.exit(0)
+
     print("🚀 Nebius Mistral Tool Behavior Analysis")
     print("=" * 50)
     
-    test_without_tools()
-    test_with_tools_no_choice()
-    test_with_specific_tool()
+    # one client for all tests, so they share its connection pool
+    client = setup_client()
+    test_without_tools(client)
+    test_with_tools_no_choice(client)
+    test_with_specific_tool(client)
     
     print("\n✨ Analysis completed!")
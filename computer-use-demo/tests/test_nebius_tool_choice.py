@@ -3,36 +3,55 @@
 """
 Test script to verify how Nebius provider handles different tool_choice values
 with multiple tools available.
+
+Run from computer-use-demo with: python -m tests.test_nebius_tool_choice
+(pytest finds computer_use_demo through the pythonpath set in pyproject.toml)
 """
 
-import sys
 import os
+import sys
 import json
 import asyncio
+import functools
+import hashlib
 from typing import Any, Dict, List
 
-# Add path to import computer_use_demo modules
-sys.path.append(os.path.join(os.path.dirname(__file__), 'computer_use_demo'))
+import httpx
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient
 
-from openai import OpenAI
+try:
+    import h2  # noqa: F401  (lets httpx speak HTTP/2, pinned in dev-requirements.txt)
+
+    HTTP2 = True
+except ImportError:
+    HTTP2 = False
 from computer_use_demo.loop import (
-    _convert_anthropic_tools_to_openai,
     _convert_openai_response_to_anthropic,
-    APIProvider
+    APIProvider,
+    openai_tools_for_version
 )
-from computer_use_demo.tools import ToolCollection, TOOL_GROUPS_BY_VERSION
 
 def setup_nebius_client():
     """Setup Nebius OpenAI client"""
-    # You need to set your API key here or in environment
+    # main() exits early when NEBIUS_API_KEY is not set
     api_key = os.getenv("NEBIUS_API_KEY")
-    if not api_key:
-        print("⚠️  Warning: NEBIUS_API_KEY not set. Using placeholder.")
-        api_key = "your-api-key-here"
     
-    return OpenAI(
+    # The SDK retries rate limited (429) and transient errors with exponential
+    # backoff, honouring retry-after; the probe matrix gets a larger budget than
+    # the default 2 so that it finishes under a quota instead of logging failures
+    # With HTTP/2 the concurrent probes are multiplexed over a few connections
+    # instead of each opening its own TLS connection
+    return AsyncOpenAI(
         base_url="https://api.studio.nebius.com/v1/",
-        api_key=api_key
+        api_key=api_key,
+        max_retries=MAX_RETRIES,
+        http_client=DefaultAsyncHttpxClient(
+            http2=HTTP2,
+            limits=httpx.Limits(
+                max_connections=MAX_PARALLEL_REQUESTS,
+                max_keepalive_connections=MAX_PARALLEL_REQUESTS
+            )
+        )
     )
 
 # Models to test
@@ -43,43 +62,64 @@ MODELS_TO_TEST = [
     "Qwen/Qwen2.5-VL-72B-Instruct"
 ]
 
+# Every (model, tool_choice) probe runs concurrently, at most this many at a time
+# (MAX_PARALLEL overrides the cap, e.g. to stay under a lower account rate limit)
+MAX_PARALLEL_REQUESTS = int(os.getenv("MAX_PARALLEL", "16"))
+MAX_RETRIES = 6
+# Set FULL_MATRIX=1 to also probe requests that omit tool_choice entirely
+FULL_MATRIX = bool(os.getenv("FULL_MATRIX"))
+_request_slots = asyncio.Semaphore(MAX_PARALLEL_REQUESTS)
+
+async def create_completion(client: AsyncOpenAI, **kwargs):
+    """Create a chat completion, waiting for a free request slot first"""
+    async with _request_slots:
+        return await client.chat.completions.create(
+            **kwargs,
+            # sent as a raw field: older openai SDKs don't accept the kwarg
+            extra_body={"prompt_cache_key": get_prompt_cache_key()}
+        )
+
+@functools.lru_cache(maxsize=1)
 def get_test_tools():
-    """Get available tools for testing"""
+    """Get available tools for testing, built once and shared by every probe"""
     # Set required environment variables for computer tool
     os.environ.setdefault("WIDTH", "1920")
     os.environ.setdefault("HEIGHT", "1080")
     
-    tool_version = "computer_use_20250124"
-    tool_group = TOOL_GROUPS_BY_VERSION[tool_version]
-    tool_collection = ToolCollection(*(ToolCls() for ToolCls in tool_group.tools))
-    
-    # Convert to OpenAI format
-    anthropic_tools = tool_collection.to_params()
-    openai_tools = _convert_anthropic_tools_to_openai(anthropic_tools)
+    openai_tools = list(openai_tools_for_version("computer_use_20250124"))
     
     return openai_tools, [tool["function"]["name"] for tool in openai_tools]
 
-def create_test_messages():
-    """Create test messages that could use multiple tools"""
-    return [
-        {
-            "role": "system",
-            "content": "You are a helpful assistant with access to computer tools. You can take screenshots, edit files, and run bash commands."
-        },
-        {
-            "role": "user", 
-            "content": "I need to take a screenshot of my desktop and then create a simple text file with the current date. Can you help me with this?"
-        }
-    ]
+# Test messages that could use multiple tools, shared (read-only) by every probe
+TEST_MESSAGES = (
+    {
+        "role": "system",
+        "content": "You are a helpful assistant with access to computer tools. You can take screenshots, edit files, and run bash commands."
+    },
+    {
+        "role": "user",
+        "content": "I need to take a screenshot of my desktop and then create a simple text file with the current date. Can you help me with this?"
+    }
+)
 
-async def test_tool_choice_none(client: OpenAI, tools: List[Dict], tool_names: List[str], model: str):
+@functools.lru_cache(maxsize=1)
+def get_prompt_cache_key() -> str:
+    """Cache key of the tools + TEST_MESSAGES prefix that every probe shares"""
+    # only tool_choice differs between probes, so one key routes each model's
+    # variants to where that prefix is cached
+    tools, _ = get_test_tools()
+    prefix = json.dumps([tools, TEST_MESSAGES], sort_keys=True)
+    return hashlib.sha256(prefix.encode()).hexdigest()[:32]
+
+async def test_tool_choice_none(client: AsyncOpenAI, tools: List[Dict], tool_names: List[str], model: str, lines: List[str]):
     """Test with tool_choice=None"""
-    print(f"🔍 Testing tool_choice=None with {model}")
+    lines.append(f"🔍 Testing tool_choice=None with {model}")
     
-    messages = create_test_messages()
+    messages = TEST_MESSAGES
     
     try:
-        response = client.chat.completions.create(
+        response = await create_completion(
+            client,
             model=model,
             messages=messages,
             tools=tools,
@@ -89,31 +129,32 @@ async def test_tool_choice_none(client: OpenAI, tools: List[Dict], tool_names: L
         
         choice = response.choices[0].message
         
-        print(f"✅ Response with tool_choice=None:")
+        lines.append(f"✅ Response with tool_choice=None:")
         if choice.content:
-            print(f"   Content: {choice.content[:200]}...")
+            lines.append(f"   Content: {choice.content[:200]}...")
         
         if choice.tool_calls:
-            print(f"   Tool calls made: {len(choice.tool_calls)}")
+            lines.append(f"   Tool calls made: {len(choice.tool_calls)}")
             for tool_call in choice.tool_calls:
-                print(f"   - {tool_call.function.name}: {tool_call.function.arguments[:100]}...")
+                lines.append(f"   - {tool_call.function.name}: {tool_call.function.arguments[:100]}...")
         else:
-            print("   No tool calls made")
+            lines.append("   No tool calls made")
             
         return response
         
     except Exception as e:
-        print(f"❌ Error with tool_choice=None: {e}")
+        lines.append(f"❌ Error with tool_choice=None: {e}")
         return None
 
-async def test_no_tool_choice(client: OpenAI, tools: List[Dict], tool_names: List[str], model: str):
+async def test_no_tool_choice(client: AsyncOpenAI, tools: List[Dict], tool_names: List[str], model: str, lines: List[str]):
     """Test without specifying tool_choice at all"""
-    print(f"\n🔍 Testing without tool_choice parameter with {model}")
+    lines.append(f"\n🔍 Testing without tool_choice parameter with {model}")
     
-    messages = create_test_messages()
+    messages = TEST_MESSAGES
     
     try:
-        response = client.chat.completions.create(
+        response = await create_completion(
+            client,
             model=model,
             messages=messages,
             tools=tools,
@@ -123,31 +164,32 @@ async def test_no_tool_choice(client: OpenAI, tools: List[Dict], tool_names: Lis
         
         choice = response.choices[0].message
         
-        print(f"✅ Response without tool_choice:")
+        lines.append(f"✅ Response without tool_choice:")
         if choice.content:
-            print(f"   Content: {choice.content[:200]}...")
+            lines.append(f"   Content: {choice.content[:200]}...")
         
         if choice.tool_calls:
-            print(f"   Tool calls made: {len(choice.tool_calls)}")
+            lines.append(f"   Tool calls made: {len(choice.tool_calls)}")
             for tool_call in choice.tool_calls:
-                print(f"   - {tool_call.function.name}: {tool_call.function.arguments[:100]}...")
+                lines.append(f"   - {tool_call.function.name}: {tool_call.function.arguments[:100]}...")
         else:
-            print("   No tool calls made")
+            lines.append("   No tool calls made")
             
         return response
         
     except Exception as e:
-        print(f"❌ Error without tool_choice: {e}")
+        lines.append(f"❌ Error without tool_choice: {e}")
         return None
 
-async def test_tool_choice_auto(client: OpenAI, tools: List[Dict], tool_names: List[str], model: str):
+async def test_tool_choice_auto(client: AsyncOpenAI, tools: List[Dict], tool_names: List[str], model: str, lines: List[str]):
     """Test with tool_choice='auto'"""
-    print(f"\n🔍 Testing tool_choice='auto' with {model}")
+    lines.append(f"\n🔍 Testing tool_choice='auto' with {model}")
     
-    messages = create_test_messages()
+    messages = TEST_MESSAGES
     
     try:
-        response = client.chat.completions.create(
+        response = await create_completion(
+            client,
             model=model,
             messages=messages,
             tools=tools,
@@ -157,31 +199,32 @@ async def test_tool_choice_auto(client: OpenAI, tools: List[Dict], tool_names: L
         
         choice = response.choices[0].message
         
-        print(f"✅ Response with tool_choice='auto':")
+        lines.append(f"✅ Response with tool_choice='auto':")
         if choice.content:
-            print(f"   Content: {choice.content[:200]}...")
+            lines.append(f"   Content: {choice.content[:200]}...")
         
         if choice.tool_calls:
-            print(f"   Tool calls made: {len(choice.tool_calls)}")
+            lines.append(f"   Tool calls made: {len(choice.tool_calls)}")
             for tool_call in choice.tool_calls:
-                print(f"   - {tool_call.function.name}: {tool_call.function.arguments[:100]}...")
+                lines.append(f"   - {tool_call.function.name}: {tool_call.function.arguments[:100]}...")
         else:
-            print("   No tool calls made")
+            lines.append("   No tool calls made")
             
         return response
         
     except Exception as e:
-        print(f"❌ Error with tool_choice='auto': {e}")
+        lines.append(f"❌ Error with tool_choice='auto': {e}")
         return None
 
-async def test_tool_choice_required(client: OpenAI, tools: List[Dict], tool_names: List[str], model: str):
+async def test_tool_choice_required(client: AsyncOpenAI, tools: List[Dict], tool_names: List[str], model: str, lines: List[str]):
     """Test with tool_choice='required'"""
-    print(f"\n🔍 Testing tool_choice='required' with {model}")
+    lines.append(f"\n🔍 Testing tool_choice='required' with {model}")
     
-    messages = create_test_messages()
+    messages = TEST_MESSAGES
     
     try:
-        response = client.chat.completions.create(
+        response = await create_completion(
+            client,
             model=model,
             messages=messages,
             tools=tools,
@@ -191,37 +234,38 @@ async def test_tool_choice_required(client: OpenAI, tools: List[Dict], tool_name
         
         choice = response.choices[0].message
         
-        print(f"✅ Response with tool_choice='required':")
+        lines.append(f"✅ Response with tool_choice='required':")
         if choice.content:
-            print(f"   Content: {choice.content[:200]}...")
+            lines.append(f"   Content: {choice.content[:200]}...")
         
         if choice.tool_calls:
-            print(f"   Tool calls made: {len(choice.tool_calls)}")
+            lines.append(f"   Tool calls made: {len(choice.tool_calls)}")
             for tool_call in choice.tool_calls:
-                print(f"   - {tool_call.function.name}: {tool_call.function.arguments[:100]}...")
+                lines.append(f"   - {tool_call.function.name}: {tool_call.function.arguments[:100]}...")
         else:
-            print("   ⚠️  No tool calls made (unexpected with 'required')")
+            lines.append("   ⚠️  No tool calls made (unexpected with 'required')")
             
         return response
         
     except Exception as e:
-        print(f"❌ Error with tool_choice='required': {e}")
+        lines.append(f"❌ Error with tool_choice='required': {e}")
         return None
 
-async def test_tool_choice_specific(client: OpenAI, tools: List[Dict], tool_names: List[str], model: str):
+async def test_tool_choice_specific(client: AsyncOpenAI, tools: List[Dict], tool_names: List[str], model: str, lines: List[str]):
     """Test with tool_choice specifying a specific tool"""
-    print(f"\n🔍 Testing tool_choice with specific tool using {model}")
+    lines.append(f"\n🔍 Testing tool_choice with specific tool using {model}")
     
     # Choose the first available tool
     if not tool_names:
-        print("   ⚠️  No tools available for specific choice test")
+        lines.append("   ⚠️  No tools available for specific choice test")
         return None
         
     specific_tool = tool_names[0]  # Use first tool (likely 'computer')
-    messages = create_test_messages()
+    messages = TEST_MESSAGES
     
     try:
-        response = client.chat.completions.create(
+        response = await create_completion(
+            client,
             model=model,
             messages=messages,
             tools=tools,
@@ -234,40 +278,55 @@ async def test_tool_choice_specific(client: OpenAI, tools: List[Dict], tool_name
         
         choice = response.choices[0].message
         
-        print(f"✅ Response with tool_choice='{specific_tool}':")
+        lines.append(f"✅ Response with tool_choice='{specific_tool}':")
         if choice.content:
-            print(f"   Content: {choice.content[:200]}...")
+            lines.append(f"   Content: {choice.content[:200]}...")
         
         if choice.tool_calls:
-            print(f"   Tool calls made: {len(choice.tool_calls)}")
+            lines.append(f"   Tool calls made: {len(choice.tool_calls)}")
             for tool_call in choice.tool_calls:
-                print(f"   - {tool_call.function.name}: {tool_call.function.arguments[:100]}...")
+                lines.append(f"   - {tool_call.function.name}: {tool_call.function.arguments[:100]}...")
                 if tool_call.function.name != specific_tool:
-                    print(f"   ⚠️  Expected {specific_tool}, got {tool_call.function.name}")
+                    lines.append(f"   ⚠️  Expected {specific_tool}, got {tool_call.function.name}")
         else:
-            print("   ⚠️  No tool calls made (unexpected with specific tool choice)")
+            lines.append("   ⚠️  No tool calls made (unexpected with specific tool choice)")
             
         return response
         
     except Exception as e:
-        print(f"❌ Error with tool_choice='{specific_tool}': {e}")
+        lines.append(f"❌ Error with tool_choice='{specific_tool}': {e}")
         return None
 
-async def test_model(client: OpenAI, tools: List[Dict], tool_names: List[str], model: str):
+async def test_model(client: AsyncOpenAI, tools: List[Dict], tool_names: List[str], model: str):
     """Test a specific model with all tool_choice variations"""
-    print(f"\n{'='*60}")
-    print(f"🔬 Testing Model: {model}")
-    print(f"{'='*60}")
-    
-    responses = {}
-    
-    responses["None"] = await test_tool_choice_none(client, tools, tool_names, model)
-    responses["No choice"] = await test_no_tool_choice(client, tools, tool_names, model)
-    responses["Auto"] = await test_tool_choice_auto(client, tools, tool_names, model)
-    responses["Required"] = await test_tool_choice_required(client, tools, tool_names, model)
-    responses["Specific"] = await test_tool_choice_specific(client, tools, tool_names, model)
+    variants = {
+        "None": test_tool_choice_none,
+        "Auto": test_tool_choice_auto,
+        "Required": test_tool_choice_required,
+        "Specific": test_tool_choice_specific,
+    }
+    if FULL_MATRIX:
+        # tool_choice=None and omitting tool_choice both mean "the model decides"
+        # (the API default), so the omitted variant is only probed on request
+        variants = {"None": test_tool_choice_none, "No choice": test_no_tool_choice, **variants}
+    # Concurrent variants buffer their output, which is printed in one block
+    # per model once they are all done, instead of interleaving on stdout
+    variant_lines = [[] for _ in variants]
+    results = await asyncio.gather(
+        *(
+            test(client, tools, tool_names, model, lines)
+            for test, lines in zip(variants.values(), variant_lines)
+        )
+    )
     
-    return responses
+    print("\n".join([
+        f"\n{'='*60}",
+        f"🔬 Testing Model: {model}",
+        f"{'='*60}",
+        *(line for lines in variant_lines for line in lines),
+    ]))
+
+    return dict(zip(variants, results))
 
 def compare_responses(responses: Dict[str, Any], model: str):
     """Compare responses from different tool_choice values"""
@@ -292,11 +351,15 @@ def compare_responses(responses: Dict[str, Any], model: str):
 
 async def main():
     """Main test function"""
+    if not os.getenv("NEBIUS_API_KEY"):
+        # every request would fail with 401, don't send any
+        print("SKIP: NEBIUS_API_KEY not set")
+        sys.exit(0)
+
     print("🚀 Testing Nebius Tool Choice Behavior Across Multiple Models")
     print("=" * 70)
     
     # Setup
-    client = setup_nebius_client()
     tools, tool_names = get_test_tools()
     
     print(f"Available tools: {tool_names}")
@@ -305,15 +368,20 @@ async def main():
     
     all_results = {}
     
-    # Test each model
-    for model in MODELS_TO_TEST:
-        try:
-            model_responses = await test_model(client, tools, tool_names, model)
-            all_results[model] = model_responses
-            compare_responses(model_responses, model)
-        except Exception as e:
-            print(f"❌ Failed to test model {model}: {e}")
-            all_results[model] = {"error": str(e)}
+    # Test all models concurrently, then report them in order; leaving the
+    # client's context closes its pooled connections
+    async with setup_nebius_client() as client:
+        model_results = await asyncio.gather(
+            *(test_model(client, tools, tool_names, model) for model in MODELS_TO_TEST),
+            return_exceptions=True
+        )
+    for model, model_responses in zip(MODELS_TO_TEST, model_results):
+        if isinstance(model_responses, Exception):
+            print(f"❌ Failed to test model {model}: {model_responses}")
+            all_results[model] = {"error": str(model_responses)}
+            continue
+        all_results[model] = model_responses
+        compare_responses(model_responses, model)
     
     # Final summary
     print(f"\n{'='*70}")
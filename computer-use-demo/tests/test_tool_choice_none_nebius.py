@@ -3,12 +3,41 @@
 """
 Test script to check how Nebius models respond when tools are provided 
 but tool_choice is set to None.
+
+Run from computer-use-demo with: python -m tests.test_tool_choice_none_nebius
+(all models at once), or with pytest, one test per model.
 """
 
 import asyncio
+import contextlib
+import hashlib
 import json
+import logging
 import os
-from openai import OpenAI
+import re
+import shelve
+import sys
+from collections.abc import AsyncIterator
+from dataclasses import dataclass
+
+import httpx
+import pytest
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient
+from openai.lib.streaming.chat import ChatCompletionStreamState
+from openai.types.chat import ChatCompletion
+
+try:
+    import h2  # noqa: F401  (lets httpx speak HTTP/2, pinned in dev-requirements.txt)
+
+    HTTP2 = True
+except ImportError:
+    HTTP2 = False
+
+logger = logging.getLogger(__name__)
+
+# Set NEBIUS_RESPONSE_CACHE to a file path to reuse responses across reruns
+# instead of querying every model again; unset, every run hits the API
+RESPONSE_CACHE_PATH = os.getenv("NEBIUS_RESPONSE_CACHE")
 
 # Simple calculator tool definition for testing
 CALCULATOR_TOOL = {
@@ -29,74 +58,208 @@ CALCULATOR_TOOL = {
     }
 }
 
-def test_nebius_tool_choice_none():
-    """Test Nebius models with tool_choice=None"""
-    
-    # Get API key from environment or prompt user
-    api_key = os.getenv("NEBIUS_API_KEY")
-    if not api_key:
-        api_key = input("Enter your Nebius API key: ").strip()
-    
-    # Initialize OpenAI client for Nebius
-    client = OpenAI(
+# Test models
+MODELS_TO_TEST = [
+    "meta-llama/Meta-Llama-3.1-8B-Instruct",
+    "meta-llama/Meta-Llama-3.1-70B-Instruct",
+    "Qwen/Qwen2.5-72B-Instruct",
+    "mistralai/Mistral-7B-Instruct-v0.3"
+]
+
+# Test message that could trigger tool usage
+TEST_MESSAGE = "Can you calculate 15 * 23 + 47 for me?"
+
+# A response mentioning any of these shows the model understood the request
+_AWARENESS = re.compile(r"calculator|calculate|392", re.IGNORECASE)
+
+# At most this many requests are in flight; rate limited (429) and transient
+# errors are retried by the SDK with exponential backoff, honouring retry-after
+MAX_CONCURRENT_REQUESTS = 8
+MAX_RETRIES = 5
+CALL_TIMEOUT_S = 60.0
+_request_slots = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+
+# Every request sends the same messages and tools, only the model changes
+MESSAGES = [{"role": "user", "content": TEST_MESSAGE}]
+TOOLS = [CALCULATOR_TOOL]
+
+def make_client(api_key: str) -> AsyncOpenAI:
+    """Initialize OpenAI client for Nebius"""
+    # One pooled client for all models: the requests reuse kept-alive TLS
+    # connections (multiplexed over one with HTTP/2) instead of each handshaking
+    return AsyncOpenAI(
         base_url="https://api.studio.nebius.com/v1/",
-        api_key=api_key
+        api_key=api_key,
+        max_retries=MAX_RETRIES,
+        timeout=CALL_TIMEOUT_S,
+        http_client=DefaultAsyncHttpxClient(
+            http2=HTTP2,
+            limits=httpx.Limits(
+                max_connections=16,
+                max_keepalive_connections=8,
+                keepalive_expiry=30.0
+            )
+        )
     )
+
+def _first_tool_call_complete(snapshot) -> bool:
+    tool_calls = snapshot.choices[0].message.tool_calls
+    if not tool_calls:
+        return False
+    try:
+        json.loads(tool_calls[0].function.arguments)
+    except json.JSONDecodeError:
+        return False
+    return True
+
+async def read_until_tool_call(stream) -> ChatCompletion:
+    """
+    Accumulate a streamed completion, stopping as soon as the first tool call's
+    arguments are complete: whether a tool gets called is all this probe checks,
+    so the rest of the generation is not waited for.
+    """
+    state = ChatCompletionStreamState()
+    try:
+        async for chunk in stream:
+            state.handle_chunk(chunk)
+            snapshot = state.current_completion_snapshot
+            if snapshot.choices and _first_tool_call_complete(snapshot):
+                snapshot.choices[0].finish_reason = "tool_calls"
+                break
+    finally:
+        await stream.close()
+    snapshot = state.current_completion_snapshot
+    for choice in snapshot.choices:
+        # a stream that ends without a finish_reason would fail validation below
+        choice.finish_reason = choice.finish_reason or "stop"
+    return ChatCompletion.model_validate(snapshot.model_dump())
+
+@dataclass(frozen=True)
+class ProbeRequest:
+    """One probe: a model asked the messages with the tools, tool_choice=None"""
+    model: str
+    messages: list
+    tools: list
+
+async def call_one(client: AsyncOpenAI, req: ProbeRequest, cache=None) -> ChatCompletion:
+    """Send one probe, through the response cache when one is given"""
+    # Make API call with tools but tool_choice=None
+    request = {
+        "model": req.model,
+        "messages": req.messages,
+        # this probes tool dispatch, not generation quality: a tool call fits in
+        # 64 tokens, and a plain text answer is cut short instead of running on
+        "max_tokens": 64,
+        "tools": req.tools,
+        "tool_choice": None,  # This is the key parameter we're testing
+        "stream": True
+    }
+    if cache is not None:
+        # keyed on the whole request, so changing any parameter misses the cache
+        key = hashlib.sha256(json.dumps(request, sort_keys=True).encode()).hexdigest()
+        if key in cache:
+            return ChatCompletion.model_validate(cache[key])
     
-    # Test models
-    models_to_test = [
-        "meta-llama/Meta-Llama-3.1-8B-Instruct",
-        "meta-llama/Meta-Llama-3.1-70B-Instruct", 
-        "Qwen/Qwen2.5-72B-Instruct",
-        "mistralai/Mistral-7B-Instruct-v0.3"
-    ]
+    async with _request_slots:
+        response = await read_until_tool_call(
+            await client.chat.completions.create(**request)
+        )
+    if cache is not None:
+        cache[key] = response.model_dump()
+    return response
+
+async def dispatch(client: AsyncOpenAI, reqs: list[ProbeRequest], cache=None) -> list[ChatCompletion | BaseException]:
+    """Send all probes concurrently; a failed probe's exception takes its place"""
+    return await asyncio.gather(
+        *(call_one(client, req, cache) for req in reqs), return_exceptions=True
+    )
+
+def report(model: str, response: ChatCompletion | BaseException):
+    """Log how `model` responded, or why its request failed"""
+    extra = {"model": model}
+    logger.info("\n📋 Testing model: %s", model, extra=extra)
+    logger.info("-" * 40, extra=extra)
+
+    try:
+        if isinstance(response, BaseException):
+            raise response
+
+        # Analyze the response
+        message = response.choices[0].message
+
+        logger.info("✅ Model responded successfully", extra=extra)
+        logger.info("📝 Response content: %s", message.content, extra=extra)
+
+        if message.tool_calls:
+            logger.info("🔧 Tool calls made: %d", len(message.tool_calls), extra=extra)
+            for i, tool_call in enumerate(message.tool_calls):
+                logger.info("   Tool %d: %s", i + 1, tool_call.function.name, extra=extra)
+                logger.info("   Arguments: %s", tool_call.function.arguments, extra=extra)
+        else:
+            logger.info("🚫 No tool calls made", extra=extra)
+
+        # Check if model provided direct calculation
+        if _AWARENESS.search(message.content or ""):
+            logger.info("💡 Model seems aware of calculation context", extra=extra)
+
+    except Exception as e:
+        logger.error("❌ Error with %s: %s", model, e, extra=extra)
+
+@pytest.fixture
+async def client() -> AsyncIterator[AsyncOpenAI]:
+    # never prompt for the key: unattended runs would hang
+    api_key = os.getenv("NEBIUS_API_KEY")
+    if not api_key:
+        pytest.skip("NEBIUS_API_KEY not set")
+    client = make_client(api_key)
+    try:
+        yield client
+    finally:
+        # release the pooled connections
+        await client.close()
+
+@pytest.mark.parametrize("model", MODELS_TO_TEST)
+async def test_nebius_tool_choice_none(client: AsyncOpenAI, model: str):
+    """Test a Nebius model with tool_choice=None"""
+    response = await call_one(client, ProbeRequest(model, MESSAGES, TOOLS))
+    report(model, response)
     
-    # Test message that could trigger tool usage
-    test_message = "Can you calculate 15 * 23 + 47 for me?"
+    assert response.choices[0].message is not None
+    # "length" is expected when the model answers in text past max_tokens
+    assert response.choices[0].finish_reason in {"stop", "length", "tool_calls"}
+
+async def main():
+    """Test all Nebius models with tool_choice=None"""
+    api_key = os.getenv("NEBIUS_API_KEY")
+    if not api_key:
+        logger.warning("⚠️  NEBIUS_API_KEY not set, nothing to test")
+        return
     
-    print("🧪 Testing Nebius models with tool_choice=None")
-    print("=" * 60)
+    logger.info("🧪 Testing Nebius models with tool_choice=None")
+    logger.info("=" * 60)
     
-    for model in models_to_test:
-        print(f"\n📋 Testing model: {model}")
-        print("-" * 40)
-        
-        try:
-            # Make API call with tools but tool_choice=None
-            response = client.chat.completions.create(
-                model=model,
-                messages=[
-                    {"role": "user", "content": test_message}
-                ],
-                max_tokens=1000,
-                tools=[CALCULATOR_TOOL],
-                tool_choice=None  # This is the key parameter we're testing
-            )
-            
-            # Analyze the response
-            message = response.choices[0].message
-            
-            print(f"✅ Model responded successfully")
-            print(f"📝 Response content: {message.content}")
-            
-            if message.tool_calls:
-                print(f"🔧 Tool calls made: {len(message.tool_calls)}")
-                for i, tool_call in enumerate(message.tool_calls):
-                    print(f"   Tool {i+1}: {tool_call.function.name}")
-                    print(f"   Arguments: {tool_call.function.arguments}")
-            else:
-                print("🚫 No tool calls made")
-            
-            # Check if model provided direct calculation
-            if any(word in message.content.lower() for word in ['calculator', 'calculate', '392']):
-                print("💡 Model seems aware of calculation context")
-            
-        except Exception as e:
-            print(f"❌ Error with {model}: {str(e)}")
+    # Query all models concurrently, then report them in order; leaving the
+    # client's context closes its pooled connections
+    reqs = [ProbeRequest(model, MESSAGES, TOOLS) for model in MODELS_TO_TEST]
+    async with make_client(api_key) as client:
+        with (
+            shelve.open(RESPONSE_CACHE_PATH) if RESPONSE_CACHE_PATH
+            else contextlib.nullcontext()
+        ) as cache:
+            responses = await dispatch(client, reqs, cache)
+
+    for req, response in zip(reqs, responses):
+        report(req.model, response)
     
-    print("\n" + "=" * 60)
-    print("🏁 Test completed!")
+    logger.info("\n" + "=" * 60)
+    logger.info("🏁 Test completed!")
 
 
 if __name__ == "__main__":
-    test_nebius_tool_choice_none()
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    if not os.getenv("NEBIUS_API_KEY"):
+        # every request would fail with 401, don't send any
+        logger.info("SKIP: NEBIUS_API_KEY not set")
+        sys.exit(0)
+
+    asyncio.run(main())